@@ -12,20 +12,25 @@ pWellington = gp.positionVector(lonlatWellington)
 
 print('Auckland =',pAuckland,'; Wellington =',pWellington)
 
-midpoint = (pAuckland + pWellington) / gp.length(pAuckland + pWellington)
+sumAW = pAuckland + pWellington
+midpoint = sumAW / np.sqrt(sumAW @ sumAW)
 lonlatMidpoint = gp.lonlat(midpoint)
 print('Midpoint at ', lonlatMidpoint)
 
 angle = np.arccos(np.dot(pAuckland,pWellington))
 print('Distance = ',np.degrees(angle),'degrees = ',angle*gp.rEarth,'km')
 
-pole = np.cross(pAuckland,pWellington) / np.sin(angle)
+crossAW = np.cross(pAuckland,pWellington)
+if crossAW @ crossAW == 0. :
+    # Same or opposite points have no unique great circle: use any pole at 90 degrees
+    crossAW = np.cross(pAuckland, np.identity(3)[np.argmin(np.abs(pAuckland))])
+pole = crossAW / np.sqrt(crossAW @ crossAW)
 ll = gp.lonlat(pole)
 print('Pole to great circle: position vector = ',pole,'; [lon,lat] = [{0:3.3f},{1:2.3f}]'.format(ll[0],ll[1]))
 
 h = angle * pole
 rotationMatrix = gp.rotationMatrix(h)
-rotatedAuckland = np.dot(rotationMatrix,pAuckland)
+rotatedAuckland = rotationMatrix @ pAuckland
 print('pWellington = ',pWellington,'; rotatedAuckland = ',rotatedAuckland)
 
 fig,ax = gp.mapSetup([170,180,-42,-34],"Auckland to Wellington, with points between")
@@ -36,27 +41,23 @@ ax.plot([lonlatAuckland[0], lonlatWellington[0]], [lonlatAuckland[1], lonlatWell
 
 # Use rotation to plot 0.1,0.2...0.9 of trip along great circle path (9 points).
 print('proportion domain =', np.linspace(0.1,0.9,9))
-for proportion in np.linspace(0.1,0.9,9):
-    rotationMatrix = gp.rotationMatrix(proportion * h)
-    rotatedAuckland = np.dot(rotationMatrix,pAuckland) 
-    ax.plot(gp.lonlat(rotatedAuckland)[0], gp.lonlat(rotatedAuckland)[1],
-            color='darkred', markersize=5, marker='o')
+# All 9 rotations share the same pole, so rotate Auckland by all 9 angles at once
+angles = np.linspace(0.1,0.9,9) * angle
+rotatedAuckland = gp.rotateAboutAxis(pole, angles, pAuckland)   # shape (9,3)
+lonlatRotated = gp.lonlat(rotatedAuckland)  # shape (9,2)
+# One plot call for all 9 points; linestyle='None' so they are not joined
+ax.plot(lonlatRotated[:,0], lonlatRotated[:,1], linestyle='None',
+        color='darkred', markersize=5, marker='o')
 
 # Now consider a semi-circular (small circle) path with lots of points around the midpoint
 # Rotation parameters: 180 degrees is pi radians, and the path is around the midpoint
-hNew = np.pi * midpoint 
-# Use a list [] to store each point along the path. Auckland is the start point
-path = list()
-path.append(lonlatAuckland)
-# We could also instantiate the list in one line with: path = [lonlatAuckland]
+# Make an array of n angles from 0 to pi about the midpoint. 0 is no rotation (Auckland)
 n = 40
-for i in range(1,n):
-    rotationMatrix = gp.rotationMatrix(i/n * hNew)
-    rotatedPositionVector = np.dot(rotationMatrix,pAuckland)
-    path.append(gp.lonlat(rotatedPositionVector))
+pathAngles = np.pi * np.arange(n)/n
+rotatedPositionVectors = gp.rotateAboutAxis(midpoint, pathAngles, pAuckland)   # shape (n,3)
 
-# Convert the path list to an array and transpose, to give better shape for plotting
-pathArray = np.transpose(np.asarray(path)) # could also have used = np.asarray(path).T
+# Convert to [lon,lat] and transpose, to give better shape for plotting
+pathArray = gp.lonlat(rotatedPositionVectors).T
 print('pathArray \n',pathArray)
     
 ax.plot(pathArray[0],pathArray[1], color='darkblue', linewidth=2)
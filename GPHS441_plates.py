@@ -3,25 +3,131 @@
     GPHS/PHYS 441 plate rotation functions
     Rupert Sutherland - Geodynamics module
 """
+import os
+import hashlib
+import inspect
+import warnings
+from functools import lru_cache
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: without it the kernels below run as plain numpy
+    def njit(*args, **kwargs):
+        return lambda function: function
+
 rEarth = 6371.0  # km
 
+# Compiled kernels for a single float 3-vector (np.array with shape (3,)).
+# They do no input checking - use the public functions further below.
+
+@njit(cache=True, error_model='numpy')
+def _length3(v):
+    return np.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+
+@njit(cache=True, error_model='numpy')
+def _lonlat3(v):
+    L = _length3(v)
+    lat = np.degrees(np.arcsin(v[2]/L))
+    lon = np.mod(np.degrees(np.arctan2(v[1], v[0])), 360.)
+    return np.array([lon, lat])
+
+@njit(cache=True, error_model='numpy')
+def _M3(h):
+    H = np.zeros((3,3))
+    H[0,1] = -h[2]
+    H[0,2] =  h[1]
+    H[1,0] =  h[2]
+    H[1,2] = -h[0]
+    H[2,0] = -h[1]
+    H[2,1] =  h[0]
+    return H
+
+@njit(cache=True, error_model='numpy')
+def _rotationMatrix3(h):
+    angle = _length3(h)
+    if angle == 0. :
+        return np.identity(3)
+
+    # Rodrigues formula R = I + sin(angle)*P + (1-cos(angle))*PP, P = M(pole),
+    # written out element by element using PP = (pole pole^T - I)
+    x = h[0]/angle
+    y = h[1]/angle
+    z = h[2]/angle
+    s = np.sin(angle)
+    c = 1. - np.cos(angle)
+    return np.array([[1. - c*(y*y + z*z), -s*z + c*x*y,       s*y + c*x*z],
+                     [ s*z + c*x*y,       1. - c*(x*x + z*z), -s*x + c*y*z],
+                     [-s*y + c*x*z,        s*x + c*y*z,       1. - c*(x*x + y*y)]])
+
+def _kernelHash():
+    """
+    Hash of the kernel source code above, stored in the ahead-of-time build
+    so that a build made before the kernels were edited is not used.
+    """
+    kernels = (_length3, _lonlat3, _M3, _rotationMatrix3)
+    source = ''.join(inspect.getsource(getattr(f,'py_func',f)) for f in kernels)
+    return int(hashlib.sha1(source.encode()).hexdigest()[:15], 16)
+
+# Use the ahead-of-time compiled kernels instead, if built by build_kernels.py
+try:
+    import gphs441_kernels
+except ImportError:
+    pass
+else:
+    if gphs441_kernels._kernelHash() == _kernelHash() :
+        from gphs441_kernels import _length3, _lonlat3, _M3, _rotationMatrix3
+    else:
+        warnings.warn('gphs441_kernels is out of date with GPHS441_plates.py, '
+                      'using the python kernels. Rebuild: python build_kernels.py')
+
+# Array kernels for float arrays of 3-vectors with shape (N,3), also unchecked.
+
+def _lonlatN(v):
+    # Convert to position vectors
+    v = v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+    lat = np.degrees(np.arcsin(v[...,2]))
+
+    # longitude: arctan2 uses the sign of x and y to give -180 to +180,
+    # including the x=0 and y=0 cases
+    lon = np.degrees(np.arctan2(v[...,1], v[...,0]))
+
+    # comment out the line below to keep longitude as -180/180
+    lon = np.mod(lon,360)
+
+    return np.stack([lon,lat], axis=-1)
+
+def _rotationMatrixN(h):
+    angle = np.linalg.norm(h, axis=-1)
+    # zero rotations leave h = 0, so s = c = 0 and R is the identity
+    x, y, z = (h / np.where(angle == 0, 1., angle)[:,None]).T
+    s = np.sin(angle)
+    c = 1. - np.cos(angle)
+    R = np.array([[1. - c*(y*y + z*z), -s*z + c*x*y,       s*y + c*x*z],
+                  [ s*z + c*x*y,       1. - c*(x*x + z*z), -s*x + c*y*z],
+                  [-s*y + c*x*z,        s*x + c*y*z,       1. - c*(x*x + y*y)]])
+    return np.moveaxis(R, -1, 0)
+
 def length(vector):
     """
     Find the length of a vector of floats.
-    
+    For an array of vectors, the length of each is taken along the last axis.
+
     Parameters
     ----------
-    vector : n-dimensional array-like object
+    vector : n-dimensional array-like object, or array of them with shape (N,n)
 
     Returns
     -------
-    vectorLength : float with positive or zero value
+    vectorLength : float with positive or zero value, or np.array shape (N,)
     """
-    v = np.array(vector, dtype=float)
-    return np.sqrt(v.dot(v))
+    v = np.asarray(vector, dtype=float)
+    if v.ndim <= 1 :
+        return np.sqrt(v.dot(v))
+    return np.linalg.norm(v, axis=-1)
 
 def positionVector(lonlat):
     """
@@ -33,18 +139,25 @@ def positionVector(lonlat):
 
     Parameters
     ----------
-    lonlat : array-like object [longitude,latitude] 
+    lonlat : array-like object [longitude,latitude], or shape (N,2)
 
     Returns
     -------
-    positionVector : np.array([x,y,z]) with unit length
-    """    
-    lon = np.radians(float(lonlat[0]))
-    lat = np.radians(float(lonlat[1]))
-    x = np.cos(lon)*np.cos(lat)
-    y = np.sin(lon)*np.cos(lat)
+    positionVector : np.array([x,y,z]) with unit length, or shape (N,3)
+    """
+    ll = np.radians(np.asarray(lonlat, dtype=float))
+    if ll.ndim == 1 :
+        # single point: scalar arithmetic is quicker than stacking arrays
+        lon, lat = ll
+        cosLat = np.cos(lat)
+        return np.array([np.cos(lon)*cosLat, np.sin(lon)*cosLat, np.sin(lat)])
+    lon = ll[...,0]
+    lat = ll[...,1]
+    cosLat = np.cos(lat)
+    x = np.cos(lon)*cosLat
+    y = np.sin(lon)*cosLat
     z = np.sin(lat)
-    return np.array([x,y,z])
+    return np.stack([x,y,z], axis=-1)
 
 def lonlat(vector):
     """
@@ -54,47 +167,26 @@ def lonlat(vector):
 
     Parameters
     ----------
-    vector : [x,y,z] (array-like object)
+    vector : [x,y,z] (array-like object), or an array of them with shape (N,3)
 
     Returns
     -------
-    np.array([longitude,latitude])
+    np.array([longitude,latitude]), or np.array with shape (N,2)
     """
-    # Ensure a 3-vector of floating point numbers else raise exception
-    v = np.array(vector, dtype=float)
-    if np.shape(v) != (3,) :
+    # Ensure 3-vector(s) of floating point numbers else raise exception
+    v = np.asarray(vector, dtype=float)
+    if np.shape(v)[-1:] != (3,) :
         raise ValueError('lonlat(): expects 3-vector')
-        
-    # Convert to position vector
-    L = length(v)
-    x = v[0]/L
-    y = v[1]/L
-    z = v[2]/L
-    
-    lat = np.degrees(np.arcsin(z))
-    
-    # longitude: arctan only defined for -90 to 90, and error if x=0
-    # longitude: require -180 to +180, so use sign of x and y
-    if x == 0 :
-        lon = np.sign(y) * 90.
-    elif x > 0 :
-        lon = np.degrees(np.arctan(y/x))
-    elif y == 0 :
-        lon = 180. + np.degrees(np.arctan(y/x))
-    else:
-        lon = np.sign(y) * 180. + np.degrees(np.arctan(y/x))
-    
-    # comment out the line below to keep longitude as -180/180
-    lon = np.mod(lon,360)
-    
-    return np.array([lon,lat])
+    if np.ndim(v) == 1 :
+        return _lonlat3(v)
+    return _lonlatN(v)
 
 def M(h):
     """
     Function that returns the 3x3 matrix H from 3-vector h, such that
         Hu = h x u
     where u is 3-vector. In python, then this should be TRUE:
-    np.dot(H,u) == np.cross(h,u)
+    H @ u == np.cross(h,u)
 
     Parameters
     ----------
@@ -105,38 +197,63 @@ def M(h):
     H : 3x3 np.array 
 
     """
-    h = np.array(h, dtype=float)
+    h = np.asarray(h, dtype=float)
     if np.shape(h) != (3,) :
         raise ValueError('M(h): expects 3-vector h')
-        
-    return np.array([[ 0   ,-h[2], h[1]],
-                     [ h[2], 0   ,-h[0]],
-                     [-h[1], h[0], 0   ]])
+    return _M3(h)
 
 def rotationMatrix(h):
     """
     Converts the 3-vector h into a 3x3 rotation matrix.
+    An array of N 3-vectors gives a stack of N rotation matrices.
 
     Parameters
     ----------
-    h : 3-vector (array-like)
+    h : 3-vector (array-like), or array-like with shape = (N, 3)
 
     Returns
     -------
-    R : rotation matrix np.array with shape = (3, 3)
+    R : rotation matrix np.array with shape = (3, 3), or (N, 3, 3)
 
     """
-    h = np.array(h, dtype=float)
+    h = np.asarray(h, dtype=float)
+    if np.ndim(h) == 2 and np.shape(h)[1] == 3 :
+        return _rotationMatrixN(h)
     if np.shape(h) != (3,) :
-        raise ValueError('rotationMatrix(h): expects 3-vector h')        
-    angle = length(h)
-    I = np.identity(3)
-    if angle == 0 :
-        return I
-    else:
-        polePositionVector = h/angle
-        P = M(polePositionVector)       
-        return I + np.sin(angle)*P + (1. - np.cos(angle))*np.dot(P,P)
+        raise ValueError('rotationMatrix(h): expects 3-vector h')
+    return _rotationMatrix3(h)
+
+def rotateAboutAxis(pole, angles, vector):
+    """
+    Rotates a 3-vector about one pole by each of an array of angles.
+    Uses Rodrigues formula applied to the vector, so P.v and P.P.v are found
+    once and only sin(angle) and 1-cos(angle) vary between rotations:
+        v' = v + sin(angle)*P.v + (1-cos(angle))*P.P.v  , P = M(pole)
+
+    Parameters
+    ----------
+    pole   : 3-vector (array-like) rotation axis, need not be unit length
+    angles : float or array-like shape (N,) of angles in radians
+    vector : 3-vector (array-like) to be rotated
+
+    Returns
+    -------
+    rotated vector np.array with shape = (3,), or (N, 3)
+
+    """
+    pole = np.asarray(pole, dtype=float)
+    v = np.asarray(vector, dtype=float)
+    if np.shape(pole) != (3,) or np.shape(v) != (3,) :
+        raise ValueError('rotateAboutAxis(): expects 3-vectors pole and vector')
+    poleLength = _length3(pole)
+    if poleLength == 0 :
+        raise ValueError('rotateAboutAxis(): pole has zero length')
+
+    P = _M3(pole/poleLength)
+    Pv = P @ v
+    PPv = P @ Pv
+    angles = np.asarray(angles, dtype=float)[...,None]
+    return v + np.sin(angles)*Pv + (1. - np.cos(angles))*PPv
 
 def hVector(R):
     """
@@ -151,11 +268,123 @@ def hVector(R):
     h : numpy array 3-vector rotation parameters (length is angle in radians)
 
     """
-    angle = np.arccos((np.trace(R)-1)/2)
+    R = np.asarray(R, dtype=float)
+    # vec = 2 sin(angle) * pole, and trace(R) = 1 + 2 cos(angle)
+    # arctan2 keeps full precision for small angles, unlike arccos
     vec = np.array([R[2,1]-R[1,2],R[0,2]-R[2,0],R[1,0]-R[0,1]])
-    pole = vec/length(vec)
-    
-    return angle * pole
+    s = 0.5 * _length3(vec)
+    c = 0.5 * (np.trace(R) - 1.)
+    angle = np.arctan2(s, c)
+    if c > 0 and s < np.finfo(float).eps :
+        return np.zeros(3)
+    if c < 0 and s < 1e-6 :
+        # near pi, vec is mostly round-off. The symmetric part of R is
+        # c*I + (1-c) pole pole^T, so use its largest column for the pole
+        # and take the sign from vec
+        B = (0.5 * (R + R.T) - c * np.identity(3)) / (1. - c)
+        i = np.argmax(np.diag(B))
+        pole = B[:,i] / np.sqrt(B[i,i])
+        if pole @ vec < 0 :
+            pole = -pole
+        return angle * pole
+
+    return angle * vec / (2. * s)
+
+def quaternionFromH(h):
+    """
+    Converts the 3-vector h into a unit quaternion q = [w,x,y,z], where
+    w = cos(angle/2) and [x,y,z] = sin(angle/2) * pole.
+    Quaternions are cheaper than rotation matrices for chaining many
+    rotations (e.g. stage poles), and do not drift from being a rotation.
+
+    Parameters
+    ----------
+    h : 3-vector (array-like), or array-like with shape = (N, 3)
+
+    Returns
+    -------
+    q : quaternion np.array with shape = (4,), or (N, 4)
+
+    """
+    h = np.asarray(h, dtype=float)
+    if np.shape(h)[-1:] != (3,) :
+        raise ValueError('quaternionFromH(h): expects 3-vector h')
+    angle = length(h)[...,None]
+    # zero rotations leave h = 0, giving q = [1,0,0,0]
+    pole = h / np.where(angle == 0, 1., angle)
+    return np.concatenate([np.cos(angle/2), np.sin(angle/2) * pole], axis=-1)
+
+def quaternionCompose(q1, q2):
+    """
+    Combines two rotations, first q2 then q1 (Hamilton product q1 q2).
+    This is the same order as the matrix product R1 @ R2.
+
+    Parameters
+    ----------
+    q1, q2 : quaternions [w,x,y,z] (array-like), or shape (N, 4)
+
+    Returns
+    -------
+    q : quaternion np.array with shape = (4,), or (N, 4)
+
+    """
+    q1 = np.asarray(q1, dtype=float)
+    q2 = np.asarray(q2, dtype=float)
+    if np.shape(q1)[-1:] != (4,) or np.shape(q2)[-1:] != (4,) :
+        raise ValueError('quaternionCompose(q1,q2): expects quaternions [w,x,y,z]')
+    w1 = q1[...,:1]
+    w2 = q2[...,:1]
+    v1 = q1[...,1:]
+    v2 = q2[...,1:]
+    w = w1*w2 - np.sum(v1*v2, axis=-1, keepdims=True)
+    v = w1*v2 + w2*v1 + np.cross(v1, v2)
+    return np.concatenate([w, v], axis=-1)
+
+def quaternionApply(q, vector):
+    """
+    Rotates 3-vector(s) by quaternion(s), using
+        v' = v + 2w(u x v) + 2u x (u x v)  , where q = [w,u]
+
+    Parameters
+    ----------
+    q      : quaternion [w,x,y,z] (array-like), or shape (N, 4)
+    vector : 3-vector (array-like), or shape (N, 3)
+
+    Returns
+    -------
+    rotated vector np.array with shape = (3,), or (N, 3)
+
+    """
+    q = np.asarray(q, dtype=float)
+    v = np.asarray(vector, dtype=float)
+    if np.shape(q)[-1:] != (4,) or np.shape(v)[-1:] != (3,) :
+        raise ValueError('quaternionApply(q,vector): expects quaternion and 3-vector')
+    w = q[...,:1]
+    u = q[...,1:]
+    uv = np.cross(u, v)
+    return v + 2.*w*uv + 2.*np.cross(u, uv)
+
+def quaternionMatrix(q):
+    """
+    Converts unit quaternion(s) [w,x,y,z] to rotation matrices, e.g. for output.
+
+    Parameters
+    ----------
+    q : quaternion [w,x,y,z] (array-like), or shape (N, 4)
+
+    Returns
+    -------
+    R : rotation matrix np.array with shape = (3, 3), or (N, 3, 3)
+
+    """
+    q = np.asarray(q, dtype=float)
+    if np.shape(q)[-1:] != (4,) :
+        raise ValueError('quaternionMatrix(q): expects quaternion [w,x,y,z]')
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    R = np.array([[1. - 2.*(y*y + z*z), 2.*(x*y - w*z),      2.*(x*z + w*y)],
+                  [2.*(x*y + w*z),      1. - 2.*(x*x + z*z), 2.*(y*z - w*x)],
+                  [2.*(x*z - w*y),      2.*(y*z + w*x),      1. - 2.*(x*x + y*y)]])
+    return np.moveaxis(R, (0,1), (-2,-1))
 
 def readGMTxy(filename):
     """
@@ -167,26 +396,30 @@ def readGMTxy(filename):
         
     Returns
     -------
-    xyList : list [[[x,...],[y,...]],[[x,...],[y,...]],...]
+    xyList : list [[np.array([x,...]),np.array([y,...])],...] one per segment
 
     """
-    feature = list()
-    x = list()
-    y = list()
     with open(filename,'r') as f :
-        data = f.readlines()
-    for line in data:
-        w = line.strip().split()
-        #print(data)
-        if w[0] == '>' :
-            if x :
-                feature.append([x,y])
-            x = list()
-            y = list()
-        else:
-            x.append(float(w[0]))
-            y.append(float(w[1]))
-    return feature
+        # drop blank lines, which np.loadtxt skips and would shift the breaks
+        lines = [line for line in f if line.strip()]
+    # Segment headers start with '>'. The number of points before a header
+    # is its line number minus the number of headers above it.
+    headers = [i for i,line in enumerate(lines) if line.lstrip().startswith('>')]
+    if len(headers) == len(lines) :
+        # no points (np.loadtxt would warn about an empty file)
+        return []
+    breaks = [i - n for n,i in enumerate(headers)]
+    # Parse all points in one call, skipping the header lines
+    data = np.loadtxt(lines, comments='>', usecols=(0,1), ndmin=2)
+    return [[xy[:,0], xy[:,1]] for xy in np.split(data, breaks) if len(xy)]
+
+@lru_cache(maxsize=8)
+def _readCoastline(filename, mtime):
+    """
+    Cached readGMTxy for mapSetup. The file modification time is part of the
+    cache key, so an edited file is read again. Do not modify the result.
+    """
+    return readGMTxy(filename)
 
 def mapSetup(MAP_BOUNDS=[170,180,-42,-34],TITLE="New Zealand"):
     """
@@ -211,7 +444,8 @@ def mapSetup(MAP_BOUNDS=[170,180,-42,-34],TITLE="New Zealand"):
     ax.set_xlim(MAP_BOUNDS[0],MAP_BOUNDS[1])
     ax.set_ylim(MAP_BOUNDS[2],MAP_BOUNDS[3])
     ax.set_title(TITLE)
-    coast = readGMTxy('nzcoast.xy')
+    coastFile = os.path.abspath('nzcoast.xy')
+    coast = _readCoastline(coastFile, os.path.getmtime(coastFile))
     for line in coast:
         x,y = line
         ax.plot(x,y,linewidth=1,color='darkgrey')        
@@ -220,6 +454,29 @@ def mapSetup(MAP_BOUNDS=[170,180,-42,-34],TITLE="New Zealand"):
 if __name__ == '__main__' :
     """
     unit tests - only executes if run as stand-alone code, not when imported
-    """    
+    """
+    # hVector: identity, small angle and 180 degree round trips
+    assert np.array_equal(hVector(np.identity(3)), np.zeros(3))
+    h = np.array([1e-9, 2e-9, -1e-9])
+    assert np.allclose(hVector(rotationMatrix(h)), h, rtol=1e-12, atol=0)
+    h = np.pi * np.array([1,2,-2]) / 3
+    assert np.allclose(hVector(rotationMatrix(h)), h, rtol=0, atol=1e-12)
+
+    # readGMTxy: points before the first header, blank lines, empty segments
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', suffix='.xy', delete=False) as f :
+        f.write('0 9\n> a\n1 2\n\n3 4\n  \n> b\n> c\n5 6\n')
+    xyList = readGMTxy(f.name)
+    os.remove(f.name)
+    assert [[list(x),list(y)] for x,y in xyList] == [[[0],[9]], [[1,3],[2,4]], [[5],[6]]]
+    # readGMTxy: empty file and headers only give no segments, without warnings
+    for text in ['', '> a\n\n> b\n'] :
+        with tempfile.NamedTemporaryFile('w', suffix='.xy', delete=False) as f :
+            f.write(text)
+        with warnings.catch_warnings() :
+            warnings.simplefilter('error')
+            assert readGMTxy(f.name) == []
+        os.remove(f.name)
+
     fig,ax = mapSetup()
     plt.show()
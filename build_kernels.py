@@ -0,0 +1,34 @@
+#!python3
+"""
+    GPHS/PHYS 441 ahead-of-time compiled plate rotation kernels
+    Builds the extension module gphs441_kernels with numba.pycc, so that
+    GPHS441_plates can import compiled kernels without any run-time JIT.
+    Usage (numba and a C compiler required):  python build_kernels.py
+"""
+import os
+import sys
+from numba.pycc import CC
+
+# Compile from the python source of the kernels, not a previous build
+sys.modules['gphs441_kernels'] = None
+import GPHS441_plates as gp
+
+cc = CC('gphs441_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Kernels for a single float 3-vector, see GPHS441_plates.py.
+# positionVector is not exported: a single [lon,lat] pair is already a few
+# scalar numpy calls, and (N,2) arrays are handled in one vectorized call.
+cc.export('_length3', 'f8(f8[:])')(gp._length3.py_func)
+cc.export('_lonlat3', 'f8[:](f8[:])')(gp._lonlat3.py_func)
+cc.export('_M3', 'f8[:,:](f8[:])')(gp._M3.py_func)
+cc.export('_rotationMatrix3', 'f8[:,:](f8[:])')(gp._rotationMatrix3.py_func)
+
+# Hash of the kernel source, checked by GPHS441_plates when it imports the build
+KERNEL_HASH = gp._kernelHash()
+def _kernelHash():
+    return KERNEL_HASH
+cc.export('_kernelHash', 'i8()')(_kernelHash)
+
+if __name__ == '__main__' :
+    cc.compile()